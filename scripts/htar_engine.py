@@ -0,0 +1,1510 @@
+"""Shared archiving engine for htar.py and htar_project.py.
+
+Walks each folder, plans it into size limited archives, creates the hpss directories, runs htar, validates the
+result and deletes the local copy. Where a folder's archives go on hpss is decided by a layout policy. htar and
+hsi are run as asyncio subprocesses by an Executor; scanning and planning run in a worker thread.
+"""
+
+import sys
+from pathlib import Path
+import re
+import os
+from functools import partial, wraps
+from multiprocessing.dummy import Pool
+from threading import Thread, Event, Lock
+from collections import deque
+from subprocess import STDOUT, PIPE, CalledProcessError
+import asyncio
+import signal
+import shlex
+import shutil
+import time
+import gzip
+import hashlib
+import random
+import tempfile
+import zlib
+import sqlite3
+import json
+import fcntl
+import socket
+from contextlib import asynccontextmanager, nullcontext, closing
+import logging
+import inspect
+import io
+import atexit
+import cProfile
+import pstats
+import tracemalloc
+
+class CustomFormatter(logging.Formatter):
+    """Logging Formatter to add colors and count warning / errors"""
+    grey = "\x1b[38;21m"
+    bold = "\x1b[1m"
+    yellow = "\x1b[33;21m"
+    red = "\x1b[31;21m"
+    bold_red = "\x1b[31;1m"
+    reset = "\x1b[0m"
+    format = "%(asctime)s - %(message)s"
+    FORMATS = {
+        logging.DEBUG: grey + format + reset,
+        logging.INFO: bold + format + reset,
+        logging.WARNING: yellow + format + reset,
+        logging.ERROR: red + format + reset,
+        logging.CRITICAL: bold_red + format + reset
+    }
+    def format(self, record):
+        log_fmt = self.FORMATS.get(record.levelno)
+        formatter = logging.Formatter(log_fmt)
+        return formatter.format(record)
+
+logger = logging.getLogger("htar.py")
+
+class Profile:
+  """Collects wall clock time per pipeline phase, and optionally cProfile and tracemalloc data, for a run report"""
+  def __init__( self ):
+    self.enabled = False
+    self.phases = {}
+    self.lock = Lock()
+    self.cprofile = None
+    self.threads = []
+    self.memory = False
+    self.started = time.monotonic()
+
+  def enable( self, cprofile=False, memory=False ):
+    self.enabled = True
+    self.started = time.monotonic()
+    if cprofile:
+      # covers the event loop in the main thread; scanning and planning run in worker threads through call()
+      self.cprofile = cProfile.Profile()
+      self.cprofile.enable()
+    if memory:
+      self.memory = True
+      tracemalloc.start()
+
+  def call( self, func, *args, **kwargs ):
+    # run func, in a worker thread, under its own cProfile whose statistics are merged into the report
+    if not self.cprofile:
+      return func( *args, **kwargs )
+    prof = cProfile.Profile()
+    try:
+      prof.enable()
+    except ValueError:
+      # python 3.12+ profiles every thread from the main profiler and allows no second one
+      return func( *args, **kwargs )
+    try:
+      return func( *args, **kwargs )
+    finally:
+      prof.disable()
+      with self.lock:
+        self.threads.append( prof )
+
+  def record( self, phase, duration ):
+    with self.lock:
+      calls, total, longest = self.phases.get( phase, ( 0, 0., 0. ) )
+      self.phases[phase] = ( calls + 1, total + duration, max( longest, duration ) )
+
+  def report( self, path ):
+    # stop collecting before building the report so it does not show up in it
+    if self.memory:
+      current, peak = tracemalloc.get_traced_memory()
+      snapshot = tracemalloc.take_snapshot()
+      tracemalloc.stop()
+    if self.cprofile:
+      self.cprofile.disable()
+    text = f"# htar profile: {' '.join(sys.argv)}\n"
+    text += f"# wall time {time.monotonic() - self.started:.3f}s (phase times are inclusive of nested phases)\n\n"
+    text += f"{'phase':<24}{'calls':>10}{'total s':>14}{'mean s':>12}{'max s':>12}\n"
+    for phase, ( calls, total, longest ) in sorted( self.phases.items(), key=lambda x: -x[1][1] ):
+      text += f"{phase:<24}{calls:>10}{total:>14.3f}{total/calls:>12.3f}{longest:>12.3f}\n"
+    if self.cprofile:
+      stats = io.StringIO()
+      pstats.Stats( self.cprofile, *self.threads, stream=stats ).sort_stats( 'cumulative' ).print_stats( 40 )
+      text += f"\n# cProfile (event loop, and scanning and planning threads)\n{stats.getvalue()}"
+    if self.memory:
+      text += f"\n# tracemalloc: current {current} bytes, peak {peak} bytes, top allocations\n"
+      for stat in snapshot.statistics( 'lineno' )[:25]:
+        text += f"{stat}\n"
+    with open( path, 'w' ) as f:
+      f.write( text )
+    logger.info(f"Wrote profile report to {path}")
+
+profile = Profile()
+
+def timed( phase ):
+  # record the time spent in the decorated function against phase; for generators only time spent producing items counts,
+  # for coroutines it is wall time including any waiting
+  def decorator( func ):
+    if inspect.iscoroutinefunction( func ):
+      @wraps( func )
+      async def wrapper( *args, **kwargs ):
+        if not profile.enabled:
+          return await func( *args, **kwargs )
+        start = time.monotonic()
+        try:
+          return await func( *args, **kwargs )
+        finally:
+          profile.record( phase, time.monotonic() - start )
+    elif inspect.isgeneratorfunction( func ):
+      @wraps( func )
+      def wrapper( *args, **kwargs ):
+        if not profile.enabled:
+          yield from func( *args, **kwargs )
+          return
+        elapsed = 0
+        items = func( *args, **kwargs )
+        try:
+          while True:
+            start = time.monotonic()
+            try:
+              item = next( items )
+            except StopIteration:
+              return
+            finally:
+              elapsed += time.monotonic() - start
+            yield item
+        finally:
+          profile.record( phase, elapsed )
+    else:
+      @wraps( func )
+      def wrapper( *args, **kwargs ):
+        if not profile.enabled:
+          return func( *args, **kwargs )
+        start = time.monotonic()
+        try:
+          return func( *args, **kwargs )
+        finally:
+          profile.record( phase, time.monotonic() - start )
+    return wrapper
+  return decorator
+
+@timed('scan_directory')
+def scan_directory( root_dir ):
+  # scans the directory for all files and their size in bytes; symlinks are archived as links rather than followed
+  stack = [ root_dir ]
+  while stack:
+    with os.scandir( stack.pop() ) as entries:
+      for entry in entries:
+        if entry.is_dir( follow_symlinks=False ):
+          stack.append( entry.path )
+        else:
+          yield entry.path, entry.stat( follow_symlinks=False ).st_size
+
+def split( root_dir, max_size=10000, exclude=None ):
+  # given a root_dir, yields counter, filename, size where the counter determines the archive number based of each archive being max_size
+  n = 0
+  acc = 0
+  for filename, size in scan_directory( root_dir ):
+    if exclude and filename in exclude:
+      continue
+    #logger.debug( f'{size}\t{acc} {max_size}\t{filename}' )
+    acc += size
+    if acc > max_size:
+      n += 1
+      acc = size
+      yield n - 1, filename, size
+    else:
+      yield n, filename, size
+
+def convert_to_bytes( size ):
+  amount = int(re.sub("[^\d\.]", "", size))
+  unit = re.sub("[\d\.]", "", size).lower()
+  #logger.warn( f'amount: {amount} unit: {unit}' )
+  if unit in ('k', 'kb'):
+    amount *= 1024
+  elif unit in ('m', 'mb'):
+    amount *= 1024 * 1024
+  elif unit in ('g', 'gb'):
+    amount *= 1024 * 1024 * 1024
+  elif unit in ('t', 'tb'):
+    amount *= 1024 * 1024 * 1024 * 1024
+  return amount
+
+class FileList:
+  """Collects the member paths of one archive in a bytearray and writes them to its filelist in bulk"""
+  def __init__( self, path, prefix_path, archive_number, buffer_size=8*1024*1024 ):
+    self.path = path
+    self.prefix_path = prefix_path
+    self.archive_number = archive_number
+    self.buffer_size = buffer_size
+    self.buffer = bytearray()
+    self.files = 0
+    self.bytes = 0
+    self.peak = 0
+    # delete any old filelists
+    try:
+      os.remove( path )
+    except FileNotFoundError as e:
+      pass
+
+  def add( self, filepath, size=0 ):
+    self.buffer += os.fsencode( filepath ) + b'\n'
+    self.files += 1
+    self.bytes += size
+    self.peak = max( self.peak, len(self.buffer) )
+    if len(self.buffer) >= self.buffer_size:
+      self.flush()
+
+  def flush( self ):
+    if self.buffer:
+      with open( self.path, 'ab' ) as f:
+        f.write( self.buffer )
+      self.buffer = bytearray()
+
+  def seal( self ):
+    self.flush()
+    return { 'path': self.prefix_path, 'filelist': self.path, 'archive_number': self.archive_number, 'files': self.files, 'bytes': self.bytes }
+
+@timed('create_file_lists')
+def create_file_lists( directory, max_size=1048576, prefix_path='', working_dir='/tmp/', buffer_size=8*1024*1024, exclude=None ):
+  #logger.info(f"Building archives for directory {directory} with archive sizes of {max_size}")
+  file_lists = []
+  current = None
+  peak = 0
+  name = os.path.normpath(str(directory)).replace('/', ':')
+  logger.debug(f"organising files in {directory} into archives of size {max_size}")
+  for archive_number, filename, size in split( str(directory), max_size=max_size, exclude=exclude ):
+
+    # append the filename to the chunk
+    filepath = filename.replace( prefix_path, '' ).replace(']', '\]').replace('[', '\[')
+    #logger.debug( f'{archive_number}\t{filepath}' )
+
+    # split() never returns to an earlier archive, so the current list can be written out once the next one starts
+    if current is None or current.archive_number != archive_number:
+      if current is not None:
+        file_lists.append( current.seal() )
+        peak = max( peak, current.peak )
+      path = f'{working_dir}/htar_{name}.{archive_number}'
+      logger.debug(f"filelist path {path}")
+      current = FileList( path, prefix_path, archive_number, buffer_size=buffer_size )
+    current.add( filepath, size )
+
+  if current is not None:
+    file_lists.append( current.seal() )
+    peak = max( peak, current.peak )
+
+  logger.debug(f"wrote {len(file_lists)} filelists for {directory} to {working_dir} using at most {peak} bytes of buffer")
+  return file_lists
+
+def htar_command( archive_path, file_list, htar_path='htar', archive_cos=110, index_cos=110 ):
+  # returns the argument vectors to create the archive (run from the folder) and to list it back, and the log their output is appended to
+  log = f'{file_list}.out'
+  cmd = [ htar_path, '-Hcrc', '-Hnoglob', '-p', '-cvf', archive_path, '-L', file_list, '-Y', f'{archive_cos}:{index_cos}' ]
+  listing = [ htar_path, '-tv', '-f', archive_path ]
+  #logger.info(f"+ {cmd}")
+  return cmd, listing, Path(f'{log}')
+
+@timed('hsi_create_directory')
+async def hsi_create_directory( executor, path, hsi_path='hsi', hsi_prefix='/cryoEM/exp', dry_run=True ):
+  directory = os.path.normpath(f'{hsi_prefix}/{path}')
+  logger.info(f"Creating parent directories at {directory}")
+  cmd = [ hsi_path, 'mkdir', directory ]
+  if dry_run:
+    logger.debug(f"Not executing: {shlex.join( cmd )}")
+  else:
+    returncode, output = await executor.hsi( cmd )
+    if not returncode == 0:
+      raise CalledProcessError( returncode, cmd, output )
+  return
+
+async def create_hsi_directories( executor, directory, created=None, hsi_path='hsi', hsi_prefix='/cryoEM/exp', dry_run=True ):
+  # create each component of directory on hpss once; created maps components to their mkdir so that concurrent
+  # callers wait on a parent being created rather than racing it
+  if created is None:
+    created = {}
+  relative = ''
+  for c in str(directory).split('/'):
+    relative = relative + '/' + c
+    if not relative in created:
+      created[ relative ] = asyncio.ensure_future( hsi_create_directory( executor, relative, hsi_path=hsi_path, hsi_prefix=hsi_prefix, dry_run=dry_run ) )
+    await created[ relative ]
+  return created
+
+def is_exp_directory( path ):
+  name = os.path.basename(os.path.normpath( path ))
+  if name.startswith('20') and '-C' in name:
+    return True
+  return False
+
+def experiment_of( directory ):
+  # the experiment folder a directory given on the command line is in, or the directory itself if it is in none
+  path = os.path.normpath( directory )
+  while path and not path in ( '.', '/' ):
+    if is_exp_directory( path ):
+      return path
+    path = os.path.dirname( path )
+  return os.path.normpath( directory )
+
+
+def create_htar_extract_script( script_path, archive_paths, directory, folder, htar_path="htar", decompress=False, pointers=None, dry_run=True ):
+  header = '#' * 80 + '\n'
+  header += """# The files under %s%s has been archived to tape.
+# To restore, please send email to unix-admin@slac.stanford.edu with the full directory path to this file and ask them to execute it.
+# The htar logs for each archive are kept next to this file as <archive>.log.gz
+"""
+  header += '#' * 80 + '\n'
+  header += '\n'
+  header += "# The following commands needs to be ran to extract the archives from tape back to disk\n"
+
+  text = header % ( directory, folder )
+  logger.warning( "Creating restore script %s" % (script_path,))
+  for cmd in extract_commands( archive_paths, htar_path=htar_path ):
+    text += f"{cmd}\n"
+  if pointers:
+    text += "# Files identical to ones already on tape are restored from the archives holding them\n"
+    for cmd in pointer_commands( pointers, htar_path=htar_path ):
+      text += f"{cmd}\n"
+  if decompress:
+    text += "# Some files were gzip compressed before archiving and need decompressing once extracted\n"
+    text += f"{decompress_command( folder )}\n"
+  text += "\n"
+  text += '#' * 80 + '\n'
+  if not dry_run:
+    with open( script_path, 'w' ) as f:
+      f.write( text )
+
+def extract_commands( archive_paths, htar_path="htar" ):
+  return [ f"{htar_path} -xv -f {archive_path}" for archive_path in archive_paths ]
+
+def pointer_commands( pointers, htar_path="htar" ):
+  # restore each deduplicated file by extracting its identical copy from the archive holding it
+  q = shlex.quote
+  return [ f'(t=$(mktemp -d) && cd "$t" && {htar_path} -xv -Hnoglob -f {q(archive_path)} {q(member)} && mkdir -p "$OLDPWD"/{q(os.path.dirname(target) or ".")} && mv {q(member)} "$OLDPWD"/{q(target)}; rm -rf "$t")'
+           for target, ( archive_path, member ) in sorted( pointers.items() ) ]
+
+def decompress_command( folder ):
+  return f"find {shlex.quote(folder)} -type f -name '*{STAGED_SUFFIX}' -exec gzip -d -S {STAGED_SUFFIX} {{}} +"
+
+def update_htar_extract_script( script_path, archive_paths, folder, htar_path="htar", decompress=False, pointers=None, dry_run=True ):
+  # append the restore commands a new plan of the folder needs but its existing extract script lacks, eg the archives
+  # of compressed copies when an earlier run did not compress, or files deduplicated against archives written since;
+  # decompression is repeated after anything added
+  with open( script_path, 'r' ) as f:
+    existing = set( f.read().splitlines() )
+  commands = extract_commands( archive_paths, htar_path=htar_path ) + pointer_commands( pointers or {}, htar_path=htar_path )
+  missing = [ cmd for cmd in commands if not cmd in existing ]
+  if decompress and ( missing or not decompress_command( folder ) in existing ):
+    missing.append( decompress_command( folder ) )
+  if missing:
+    logger.warning(f"Adding {len(missing)} restore commands to existing extract script {script_path}")
+    if not dry_run:
+      with open( script_path, 'a' ) as f:
+        f.write( "# Restore commands added by a later run with a different plan for this folder\n" + ''.join( f"{cmd}\n" for cmd in missing ) )
+  return missing
+
+
+def archive_status( text, archive_path, prefix='' ):
+  # returns the byte counts of successful creates and file counts of successful listings of archive_path in htar output
+  created = re.findall(f"Create complete for {archive_path}\. (\d+) bytes written for.*\n{prefix}HTAR: HTAR SUCCESSFUL", text, re.M)
+  listed = re.findall(f"Listing complete for {archive_path}, (\d+) files .*\n{prefix}HTAR: HTAR SUCCESSFUL", text, re.M)
+  return created, listed
+
+@timed('validate_archive')
+async def validate_archive( executor, extract_script, folder_path, archive_path, cache=None, files=None, size=None ):
+  if extract_script.exists() and cache == None:
+    # logger.debug(f"Archive stub already exists {extract_script}...")
+    logger.debug(f"reading extract script {extract_script}")
+    cache = open( extract_script, 'r' ).read()
+  else:
+    logger.debug(f"using cached content for extract script {extract_script}")
+
+  logger.info(f"Validating archive {archive_path}...")
+  if not extract_script.exists():
+    logger.warning(f"Archive log {extract_script} does not exist!")
+    return False
+  logger.debug(f"checking hpss for {archive_path}")
+  # ensure it was logged as completed create succesffully
+  status = re.findall(f"^#STATUS: {re.escape(archive_path)} create=(\w+) bytes=(\d+) list=(\w+) files=(\d+)(.*)$", cache, re.M)
+  content = None
+  if status:
+    # an archive that failed is redone by a later run, which appends its own line; only the latest one counts
+    c, b, l, f, rest = status[-1]
+    archived_sizes = [ b ] if c == 'OK' else []
+    test = [ f ] if l == 'OK' else []
+    content = re.findall( r' content=(\d+)', rest )
+  else:
+    # older extract scripts carry the full htar output prefixed with #
+    archived_sizes, test = archive_status( cache, archive_path, prefix='\\#' )
+  if len(archived_sizes) == 1:
+    logger.debug(f"archive {archive_path} was logged as successfully archived with size {archived_sizes[0]}")
+    # options such as --compress change which files a folder's archives hold, as do changes to the folder itself,
+    # so an archive only counts if it holds what is planned for it now
+    if files is not None and len(test) == 1:
+      if int(test[0]) != files or ( content and int(content[-1]) != size ) or int(archived_sizes[0]) < size:
+        logger.warning(f"archive {archive_path} holds {test[0]} files in {archived_sizes[0]} bytes, but {files} files of {size} bytes are now planned for it")
+        return False
+    if folder_path.exists():
+      # ensure it exists on hpss
+      cmd = [ 'hsi', 'ls', '-l', archive_path ]
+      logger.debug(f"archive reported as uploaded, checking archive on hpss using: {shlex.join( cmd )}")
+      returncode, output = await executor.hsi( cmd )
+      if not returncode == 0:
+        logger.warn(f"HSI reports: {output.decode(errors='replace')}")
+        raise SyntaxError(f"HSI did not report archive {archive_path} exists")
+      # the size should be one of the numeric columns of the listing line, but that is not yet checked against real
+      # htar and hsi output, so a mismatch is only reported
+      listed = [ re.findall( r'(?<!\S)(\d+)(?!\S)', line ) for line in output.decode(errors='replace').splitlines() if line.rstrip().endswith( os.path.basename(archive_path) ) ]
+      if listed and not archived_sizes[0] in listed[-1]:
+        logger.warning(f"HSI does not report archive {archive_path} with the {archived_sizes[0]} bytes logged: {output.decode(errors='replace').strip()}")
+      logger.debug(f"hpss reports archive {archive_path} exists")
+
+      logger.debug(f"archive {archive_path} was logged as succesfully tested")
+      if len(test) == 1:
+        return True
+      else:
+        SyntaxError(f"Failed htar test for archive {archive_path} defined in extract script {extract_script}")
+
+      return False
+  # we shouldn't have more than one entry
+  elif len(archived_sizes) == 0:
+    return False
+  else:
+    raise SyntaxError(f"Reported archive creates for {archive_path} defined in extract script {extract_script} ({len(archived_sizes)} entries)")
+
+  return False
+
+def file_checksum( path, chunk_size=1024*1024 ):
+  checksum = hashlib.md5()
+  with open( path, 'rb' ) as f:
+    for chunk in iter( partial( f.read, chunk_size ), b'' ):
+      checksum.update( chunk )
+  return checksum.hexdigest()
+
+def compare_members( sample, scratch_dir, cwd ):
+  # returns the sampled members whose extracted copy in scratch_dir is missing or differs from the local one
+  mismatched = []
+  for m in sample:
+    member = os.fsdecode( m ).replace('\\]', ']').replace('\\[', '[')
+    extracted = os.path.join( scratch_dir, member )
+    if not os.path.isfile( extracted ) or not file_checksum( extracted ) == file_checksum( os.path.join( cwd, member ) ):
+      mismatched.append( member )
+  return mismatched
+
+@timed('verify_archive')
+async def verify_archive( executor, kwargs, samples=8, scratch='/tmp/', htar_path='htar', dry_run=True ):
+  # extract a random sample of members from the archive and compare them against the local copies
+  extract_script=kwargs['extract_script']
+  archive_path=kwargs['archive_path']
+  filelist=kwargs['filelist']
+  if dry_run:
+    logger.error(f"Not verifying archive {archive_path} -- use --force to actually verify")
+    return None
+  with open( filelist, 'rb' ) as f:
+    members = [ l.rstrip(b'\n') for l in f if l.strip() ]
+  sample = random.sample( members, min( samples, len(members) ) )
+  logger.info(f"Verifying {len(sample)} of {len(members)} members of archive {archive_path}...")
+  scratch_dir = tempfile.mkdtemp( prefix='htar_verify_', dir=scratch )
+  sample_list = f'{scratch_dir}.list'
+  mismatched = []
+  try:
+    with open( sample_list, 'wb' ) as f:
+      f.write( b''.join( m + b'\n' for m in sample ) )
+    async with executor.htar( f'verify {archive_path}' ):
+      returncode, output = await executor.run( [ htar_path, '-Hnoglob', '-xf', archive_path, '-L', sample_list ], cwd=scratch_dir, timeout=executor.timeout )
+    if not returncode == 0:
+      logger.warning(f"htar extract of {archive_path} returned {returncode}: {output.decode(errors='replace')}")
+    mismatched = await asyncio.to_thread( compare_members, sample, scratch_dir, kwargs['cwd'] )
+    for member in mismatched:
+      logger.error(f"Member {member} of archive {archive_path} does not match local copy")
+  finally:
+    shutil.rmtree( scratch_dir, ignore_errors=True )
+    os.remove( sample_list )
+  ok = returncode == 0 and len(mismatched) == 0
+  # record the outcome alongside the archive logs
+  with open( extract_script, 'a' ) as l:
+    l.write(f"#VERIFY: {archive_path} {'OK' if ok else 'FAILED'} {len(sample)-len(mismatched)}/{len(sample)} sampled members match\n")
+  return ok
+
+@timed('delete_folder')
+def delete_folder( folder_path, dry_run=True ):
+  try:
+    logger.warning(f"{'Should be ' if dry_run else ''}Deleting {folder_path}...")
+    if not dry_run:
+      shutil.rmtree( f"{folder_path}" )
+  except Exception as e:
+    logger.error(f"Could not delete {folder_path}: {e}")
+
+class ExperimentLayout:
+  """Archives every folder of every sample in an experiment (or a single folder) alongside its parent on hpss,
+  so that <exp>/<sample>/<folder> is written to <hsi_prefix>/<exp>/<sample>/<folder>.N.tar"""
+
+  def folders( self, directory ):
+    # yields ( parent, folder, hsi directory ) for each folder to archive under a directory given on the command line
+    directory_path = Path( directory )
+    if is_exp_directory( directory_path ):
+      logger.info(f"Found experimental folder {directory_path}")
+      # assume sample directories underneath
+      for sample in [x.name for x in directory_path.iterdir() if x.is_dir() and not x.is_symlink()]:
+        sample_path = Path( str(directory_path) + '/' + sample )
+        logger.info(f"Found sample folder {sample_path}")
+        for folder in [x.name for x in sample_path.iterdir() if x.is_dir() and not x.is_symlink()]:
+          logger.info(f"Found folder {sample_path}/{folder}")
+          yield str(sample_path), folder, str(sample_path)
+    else:
+      parent, folder = self.split( directory )
+      yield parent, folder, self.hsi_directory( parent, folder )
+
+  def split( self, directory ):
+    path = os.path.normpath( directory )
+    return os.path.dirname( path ) or '.', os.path.basename( path )
+
+  def hsi_directory( self, parent, folder ):
+    return parent
+
+class ProjectLayout( ExperimentLayout ):
+  """Archives a project folder into a directory of its own on hpss, so that <folder> is written to
+  <hsi_prefix>/<folder>/<folder>.N.tar; experiments are laid out as ExperimentLayout does"""
+
+  def hsi_directory( self, parent, folder ):
+    return folder
+
+STAGED_SUFFIX = '.htar.gz'
+
+def file_class( path ):
+  # files are grouped by lower case extension when deciding what to compress
+  return os.path.splitext( path )[1].lower()
+
+def compress_file( src, dst, level=1 ):
+  # gzip src to dst keeping its mode and times, reusing a copy staged by an earlier run; returns the size of dst
+  try:
+    if os.stat( dst ).st_mtime == os.stat( src ).st_mtime:
+      return os.stat( dst ).st_size
+  except FileNotFoundError:
+    pass
+  os.makedirs( os.path.dirname( dst ), exist_ok=True )
+  partial_dst = f'{dst}.part'
+  with open( src, 'rb' ) as i:
+    with gzip.GzipFile( partial_dst, 'wb', compresslevel=level, mtime=int(os.stat( src ).st_mtime) ) as o:
+      shutil.copyfileobj( i, o, 1024*1024 )
+  shutil.copystat( src, partial_dst )
+  os.replace( partial_dst, dst )
+  return os.stat( dst ).st_size
+
+class Compressor:
+  """Stages gzip'd copies of the file classes in a folder that compress well so that htar writes fewer bytes.
+
+  Compressibility is sampled per file class from the first chunk of a few files of each. Staged copies mirror
+  the folder's layout under staging_dir with STAGED_SUFFIX appended, and are archived from there in their own
+  archives; the extract script decompresses them after restoring."""
+  def __init__( self, staging_dir, ratio=0.8, level=1, samples=4, threads=4, chunk_size=1024*1024, min_size=64*1024, dry_run=True ):
+    self.staging_dir = staging_dir
+    self.ratio = ratio
+    self.level = level
+    self.samples = samples
+    self.threads = threads
+    self.chunk_size = chunk_size
+    self.min_size = min_size
+    self.dry_run = dry_run
+    self.files = 0
+    self.raw = 0
+    self.compressed = 0
+    self.estimated = 0
+    self.seconds = 0.
+
+  def sample( self, directory ):
+    # returns the compressed/raw ratio of each file class in directory
+    tested = {}
+    for filename, size in scan_directory( directory ):
+      t = tested.setdefault( file_class( filename ), [ 0, 0, 0 ] )
+      if t[2] < self.samples and size >= self.min_size:
+        with open( filename, 'rb' ) as f:
+          chunk = f.read( self.chunk_size )
+        t[0] += len(chunk)
+        t[1] += len(zlib.compress( chunk, self.level ))
+        t[2] += 1
+    return { c: t[1] / t[0] for c, t in tested.items() if t[0] }
+
+  @timed('compress')
+  def stage( self, parent, folder, exclude=None ):
+    # returns the staging directory and the set of files in folder that have been replaced by compressed copies
+    folder_path = os.path.normpath( f'{parent}/{folder}' )
+    classes = { c: r for c, r in self.sample( folder_path ).items() if r <= self.ratio }
+    if not classes:
+      return None, set()
+    staging = os.path.normpath( f'{self.staging_dir}/htar_staging/{os.path.normpath(parent)}' )
+    jobs = [ ( filename, size, f'{staging}/{os.path.relpath( filename, parent )}{STAGED_SUFFIX}' ) for filename, size in scan_directory( folder_path ) if file_class( filename ) in classes and not ( exclude and filename in exclude ) ]
+    described = ', '.join( f"{c or '(none)'} {r:.2f}" for c, r in classes.items() )
+    if self.dry_run:
+      estimate = int( sum( size * ( 1 - classes[ file_class( filename ) ] ) for filename, size, _ in jobs ) )
+      self.estimated += estimate
+      logger.info(f"Would compress {len(jobs)} files in {folder_path} ({described}), saving about {estimate} bytes")
+      return None, set()
+
+    start_time = time.monotonic()
+    with Pool( self.threads ) as pool:
+      sizes = pool.map( lambda job: compress_file( job[0], job[2], level=self.level ), jobs )
+    compressed = set()
+    raw = staged = 0
+    for ( filename, size, dst ), staged_size in zip( jobs, sizes ):
+      if staged_size < size:
+        compressed.add( filename )
+        raw += size
+        staged += staged_size
+      else:
+        os.remove( dst )
+    duration = time.monotonic() - start_time
+    self.files += len(compressed)
+    self.raw += raw
+    self.compressed += staged
+    self.seconds += duration
+    logger.info(f"Compressed {len(compressed)} files in {folder_path} ({described}) from {raw} to {staged} bytes in {duration:.1f}s")
+    return staging, compressed
+
+  def summary( self, htar_rate=None ):
+    if self.dry_run:
+      return f"Compression would save about {self.estimated} bytes"
+    saved = self.raw - self.compressed
+    text = f"Compression of {self.files} files saved {saved} of {self.raw} bytes in {self.seconds:.0f}s"
+    if htar_rate:
+      # positive when compressing cost more time than htar saved by writing fewer bytes
+      text += f", net {self.seconds - saved / htar_rate:+.0f}s at the observed htar rate of {htar_rate/1024/1024:.1f} MB/s"
+    return text
+
+def fast_hash( path, size, block_size=64*1024 ):
+  # hash the first, middle and last blocks of a file; cheap enough to check every candidate duplicate
+  checksum = hashlib.blake2b( digest_size=16 )
+  with open( path, 'rb' ) as f:
+    for offset in ( 0, max( 0, size // 2 - block_size // 2 ), max( 0, size - block_size ) ):
+      f.seek( offset )
+      checksum.update( f.read( block_size ) )
+  return checksum.hexdigest()
+
+def content_hash( path, chunk_size=1024*1024 ):
+  checksum = hashlib.blake2b()
+  with open( path, 'rb' ) as f:
+    for chunk in iter( partial( f.read, chunk_size ), b'' ):
+      checksum.update( chunk )
+  return checksum.hexdigest()
+
+class DedupIndex:
+  """Index of files already on tape, kept in an sqlite database and keyed on size plus a fast content hash.
+
+  It is populated from the filelists of archives that validated in a run. Folders being planned are checked
+  against it, and files whose full content hash matches an indexed member are left out of their folder's
+  archives; the extract script restores them from the archive holding the identical copy instead."""
+  def __init__( self, path, min_size=1024*1024, dry_run=True ):
+    self.path = path
+    self.min_size = min_size
+    self.dry_run = dry_run
+    self.files = 0
+    self.bytes = 0
+    with closing( self.connect() ) as db, db:
+      db.execute( 'CREATE TABLE IF NOT EXISTS files ( size INTEGER, fast TEXT, digest TEXT, archive TEXT, member TEXT, PRIMARY KEY ( archive, member ) )' )
+      db.execute( 'CREATE INDEX IF NOT EXISTS files_size ON files ( size, fast )' )
+
+  def connect( self ):
+    return sqlite3.connect( self.path, timeout=300 )
+
+  @timed('dedup_plan')
+  def plan( self, parent, folder, archive_prefix ):
+    # returns { filename: ( archive_path, member ) } for files in folder that are already archived elsewhere
+    folder_path = os.path.normpath( f'{parent}/{folder}' )
+    # the folder's own archives, archive_prefix.N.tar and archive_prefix.zN.tar, may be rebuilt without the file by this run
+    own = re.compile( re.escape( f'{archive_prefix}.' ) + r'z?\d+\.tar' )
+    pointers = {}
+    with closing( self.connect() ) as db:
+      for filename, size in scan_directory( folder_path ):
+        if size < self.min_size or not db.execute( 'SELECT 1 FROM files WHERE size = ? LIMIT 1', ( size, ) ).fetchone():
+          continue
+        candidates = db.execute( 'SELECT digest, archive, member FROM files WHERE size = ? AND fast = ?', ( size, fast_hash( filename, size ) ) ).fetchall()
+        digest = content_hash( filename ) if candidates else None
+        for candidate, archive_path, member in candidates:
+          if candidate == digest and not own.fullmatch( archive_path ):
+            logger.debug(f"{filename} is already archived as {member} in {archive_path}")
+            pointers[ filename ] = ( archive_path, member )
+            self.files += 1
+            self.bytes += size
+            break
+    if pointers:
+      logger.info(f"{len(pointers)} files in {folder_path} are already on tape and will not be archived again")
+    return pointers
+
+  @timed('dedup_index')
+  def add( self, kwargs ):
+    # record the members of a validated archive
+    if self.dry_run or kwargs['compressed']:
+      return
+    rows = []
+    with open( kwargs['filelist'], 'rb' ) as f:
+      for line in f:
+        member = os.fsdecode( line.rstrip(b'\n') ).replace('\\]', ']').replace('\\[', '[')
+        path = os.path.join( kwargs['cwd'], member )
+        size = os.lstat( path ).st_size
+        if size >= self.min_size and os.path.isfile( path ):
+          rows.append( ( size, fast_hash( path, size ), content_hash( path ), kwargs['archive_path'], member ) )
+    with closing( self.connect() ) as db, db:
+      # a re-created archive replaces all of its members, not just those it still holds
+      db.execute( 'DELETE FROM files WHERE archive = ?', ( kwargs['archive_path'], ) )
+      db.executemany( 'INSERT OR REPLACE INTO files VALUES ( ?, ?, ?, ?, ? )', rows )
+    logger.debug(f"indexed {len(rows)} members of {kwargs['archive_path']}")
+
+  def summary( self ):
+    return f"Deduplication skipped {self.files} files ({self.bytes} bytes) already on tape"
+
+def setup_folder( parent, folder, hsi_directory, archive_size=100*1024*1024*1024, hsi_prefix='/', dry_run=True, purge=False, working_dir='/tmp/', buffer_size=8*1024*1024, archive_cos=110, index_cos=110, compressor=None, dedup=None ):
+
+  folder_path = Path( f'{parent}/{folder}' )
+  extract_script = Path( f'{folder_path}.htar' )
+
+  logger.info(f"Generating filelists for {parent} folder {folder}...")
+  prefix = f'{os.path.normpath(parent)}/'
+  pointers = {}
+  # a purge rebuilds every archive of the folder from scratch, so nothing in it may point elsewhere
+  if dedup and not purge:
+    pointers = dedup.plan( parent, folder, os.path.normpath( f'{hsi_prefix}/{hsi_directory}/{folder}' ) )
+  staging, compressed = None, set()
+  if compressor:
+    staging, compressed = compressor.stage( parent, folder, exclude=pointers )
+  file_lists = create_file_lists( folder_path, prefix_path=prefix, max_size=archive_size, working_dir=working_dir, buffer_size=buffer_size, exclude=compressed.union( pointers ) )
+  for d in file_lists:
+    d['archive'] = f"{folder}.{d['archive_number']}.tar"
+    d['cwd'] = prefix
+    d['compressed'] = False
+  # compressed copies go into their own archives, written from the staging area
+  if staging:
+    for d in create_file_lists( Path( f'{staging}/{folder}' ), prefix_path=f'{staging}/', max_size=archive_size, working_dir=working_dir, buffer_size=buffer_size ):
+      d['archive'] = f"{folder}.z{d['archive_number']}.tar"
+      d['cwd'] = f'{staging}/'
+      d['compressed'] = True
+      file_lists.append( d )
+  for d in file_lists:
+    d['archive_path'] = os.path.normpath( f"{hsi_prefix}/{hsi_directory}/{d['archive']}" )
+
+  # do not overwrite
+  do_it = True
+  if extract_script.exists():
+    logger.warn(f"Existing extract script {extract_script} present...")
+    if purge:
+      do_it = True
+    else:
+      do_it = False
+
+  do_it = not dry_run and do_it
+  if do_it:
+    create_htar_extract_script( extract_script, [ d['archive_path'] for d in file_lists ], prefix, folder, decompress=bool(staging), pointers={ os.path.relpath( f, parent ): p for f, p in pointers.items() }, dry_run=dry_run )
+  elif extract_script.exists():
+    # options such as --compress, and a growing dedup index, change how a folder is planned, so make sure the script restores it all
+    update_htar_extract_script( extract_script, [ d['archive_path'] for d in file_lists ], folder, decompress=bool(staging), pointers={ os.path.relpath( f, parent ): p for f, p in pointers.items() }, dry_run=dry_run )
+
+  # the previous status of each archive is filled in by check_previous()
+  for d in file_lists:
+    archive = d['archive']
+    archive_path = d['archive_path']
+    ok = None
+    logger.info(f"Preparing to archive {prefix} folder {folder} to {archive} with filelist {d['filelist']}")
+    cmd, listing, log = htar_command( archive_path, d['filelist'], archive_cos=archive_cos, index_cos=index_cos )
+    yield { 'commands': cmd, 'listing': listing, 'log': log, 'extract_script': extract_script, 'filelist': d['filelist'], 'directory': folder_path, 'hsi_directory': hsi_directory, 'archive': archive, 'archive_path': archive_path, 'cwd': d['cwd'], 'compressed': d['compressed'], 'files': d['files'], 'bytes': d['bytes'], 'staging': staging and Path( f'{staging}/{folder}' ), 'exists_okay': ok }
+
+  return
+
+async def check_previous( executor, cmds, purge=False ):
+  # fill in how earlier runs left each archive of a folder, from its extract script and hpss
+  if not cmds or not cmds[0]['extract_script'].exists():
+    return cmds
+  extract_script = cmds[0]['extract_script']
+  #logger.warning(f"Archive stub already exists {extract_script}...")
+  validate = open( extract_script, 'r' ).read()
+  if not purge:
+    oks = await asyncio.gather( *[ validate_archive( executor, extract_script, c['directory'], c['archive_path'], cache=validate, files=c['files'], size=c['bytes'] ) for c in cmds ], return_exceptions=True )
+    for c, ok in zip( cmds, oks ):
+      # an archive that can not be validated, eg as hsi can not find it, is redone rather than failing the run
+      if isinstance( ok, Exception ):
+        logger.error(f"Could not validate previous archive {c['archive_path']}: {ok}")
+        ok = False
+      c['exists_okay'] = ok
+  for c in cmds:
+    logger.info(f"Archive {c['archive_path']} previous status {c['exists_okay']} {'(purge)' if purge else ''}")
+  return cmds
+
+class Prefetcher( Thread ):
+  """Warms the page cache for the files in an archive's filelist while htar is reading them.
+
+  Progress is followed by counting the files htar reports as added in its log, and no more than budget bytes
+  are warmed ahead of it. Uses posix_fadvise(WILLNEED) where available, otherwise (or with read=True) reads the
+  files in the background."""
+  def __init__( self, filelist, log, cwd='.', budget=1024*1024*1024, read=False, interval=1 ):
+    super().__init__( daemon=True )
+    self.filelist = filelist
+    self.log = log
+    self.cwd = cwd
+    self.budget = budget
+    self.read = read or not hasattr( os, 'posix_fadvise' )
+    self.interval = interval
+    self.done = Event()
+    # the log is shared by every attempt at the archive, so only follow what this one adds to it
+    self.offset = os.path.getsize( log ) if os.path.exists( log ) else 0
+    self.consumed = 0
+    self.files = 0
+    self.bytes = 0
+
+  def members( self ):
+    with open( self.filelist, 'rb' ) as f:
+      for line in f:
+        filepath = os.fsdecode( line.rstrip(b'\n') ).replace('\\]', ']').replace('\\[', '[')
+        yield os.path.join( self.cwd, filepath )
+
+  def progress( self ):
+    # count the files htar has added to the archive so far
+    try:
+      with open( self.log, 'rb' ) as f:
+        f.seek( self.offset )
+        data = f.read()
+    except FileNotFoundError:
+      return
+    end = data.rfind(b'\n') + 1
+    self.offset += end
+    self.consumed += data[:end].count(b'HTAR: a ')
+
+  def warm( self, path, length ):
+    try:
+      fd = os.open( path, os.O_RDONLY )
+    except OSError as e:
+      logger.debug(f"could not prefetch {path}: {e}")
+      return 0
+    try:
+      length = min( length, os.fstat( fd ).st_size )
+      if self.read:
+        remaining = length
+        while remaining > 0 and not self.done.is_set():
+          chunk = os.read( fd, min( remaining, 1024*1024 ) )
+          if not chunk:
+            break
+          remaining -= len(chunk)
+      else:
+        os.posix_fadvise( fd, 0, length, os.POSIX_FADV_WILLNEED )
+    finally:
+      os.close( fd )
+    return length
+
+  def run( self ):
+    ahead = deque() # bytes warmed for files htar has not reached yet
+    outstanding = 0
+    for n, path in enumerate( self.members() ):
+      while True:
+        if self.done.is_set():
+          return
+        self.progress()
+        while ahead and n - len(ahead) < self.consumed:
+          outstanding -= ahead.popleft()
+        if n < self.consumed or outstanding < self.budget:
+          break
+        self.done.wait( self.interval )
+      # htar already got there first
+      if n < self.consumed:
+        continue
+      length = self.warm( path, self.budget - outstanding )
+      ahead.append( length )
+      outstanding += length
+      self.files += 1
+      self.bytes += length
+
+  def stop( self ):
+    self.done.set()
+    self.join()
+
+
+class HtarSlots:
+  """Budget of concurrent htars shared by every invocation pointed at the same directory.
+
+  Each slot is a lock file in directory; a job holds an flock() on one for as long as its htar runs. Locks are
+  dropped by the kernel if a holder dies so slots cannot leak, and the directory can live on a shared
+  filesystem to cap htars across hosts. Slots taken by this process are also tracked in memory, as some
+  filesystems emulate flock() with per-process locks."""
+  def __init__( self, directory, slots=8, interval=10 ):
+    self.directory = directory
+    self.slots = slots
+    self.interval = interval
+    self.held = set()
+    self.lock = Lock()
+    os.makedirs( directory, exist_ok=True )
+
+  def take( self, name ):
+    for n in range( self.slots ):
+      with self.lock:
+        if n in self.held:
+          continue
+        f = open( f'{self.directory}/htar.slot.{n}', 'a+' )
+        try:
+          fcntl.flock( f, fcntl.LOCK_EX | fcntl.LOCK_NB )
+        except BlockingIOError:
+          f.close()
+          continue
+        self.held.add( n )
+      # record who holds the slot for operators
+      f.seek( 0 )
+      f.truncate()
+      f.write( f"{socket.gethostname()} {os.getpid()} {name}\n" )
+      f.flush()
+      return n, f
+    return None, None
+
+  @asynccontextmanager
+  async def acquire( self, name ):
+    start_time = time.monotonic()
+    n, f = self.take( name )
+    while f is None:
+      logger.debug(f"waiting for an htar slot in {self.directory} for {name}")
+      await asyncio.sleep( self.interval )
+      n, f = self.take( name )
+    logger.debug(f"{name} took htar slot {n} after {time.monotonic() - start_time:.0f}s")
+    try:
+      yield n
+    finally:
+      f.truncate( 0 )
+      fcntl.flock( f, fcntl.LOCK_UN )
+      f.close()
+      with self.lock:
+        self.held.discard( n )
+
+
+class Executor:
+  """Runs htar and hsi as asyncio subprocesses from argument vectors rather than through a shell.
+
+  At most htars htar processes run at once, each also holding a slot of the shared HtarSlots budget if there is
+  one. hsi calls, mostly quick checks, have their own larger limit so hundreds can be in flight without a thread
+  each. A process that outlives its timeout, or whose job is cancelled, is terminated and then killed if it has
+  not exited within grace seconds."""
+  def __init__( self, htars=4, hsis=64, slots=None, timeout=None, hsi_timeout=600, grace=30 ):
+    self.htars = htars
+    self.hsis = hsis
+    self.slots = slots
+    self.timeout = timeout
+    self.hsi_timeout = hsi_timeout
+    self.grace = grace
+    self.htar_limit = None
+    self.hsi_limit = None
+
+  def start( self ):
+    # called from within the event loop the semaphores will be used on
+    self.htar_limit = asyncio.Semaphore( self.htars )
+    self.hsi_limit = asyncio.Semaphore( self.hsis )
+
+  async def run( self, argv, log=None, cwd=None, timeout=None ):
+    # returns the exit status, None if timed out, and the output unless it was appended to log
+    argv = [ str(a) for a in argv ]
+    logger.debug(f"running {shlex.join( argv )}{f' in {cwd}' if cwd else ''}")
+    with open( log, 'ab' ) if log else nullcontext() as out:
+      if out:
+        out.write( os.fsencode( f"$ cd {cwd}\n" if cwd else '' ) + os.fsencode( f"$ {shlex.join( argv )}\n" ) )
+        out.flush()
+      proc = await asyncio.create_subprocess_exec( *argv, cwd=cwd, stdout=out or PIPE, stderr=STDOUT )
+      try:
+        output, _ = await asyncio.wait_for( proc.communicate(), timeout )
+      except asyncio.TimeoutError:
+        logger.error(f"{shlex.join( argv )} did not finish within {timeout}s")
+        await self.stop( proc )
+        return None, b''
+      except asyncio.CancelledError:
+        logger.warning(f"stopping {shlex.join( argv )}")
+        await self.stop( proc )
+        raise
+    return proc.returncode, output or b''
+
+  async def stop( self, proc ):
+    # terminate then kill, waiting at most grace seconds after each so that shutdown can never hang on a process
+    for signal_it in ( proc.terminate, proc.kill ):
+      if proc.returncode is not None:
+        return
+      try:
+        signal_it()
+      except ProcessLookupError:
+        return
+      try:
+        await asyncio.wait_for( proc.wait(), self.grace )
+        return
+      except asyncio.TimeoutError:
+        pass
+    logger.error(f"gave up waiting for pid {proc.pid} to exit")
+
+  @asynccontextmanager
+  async def htar( self, name ):
+    # hold one of this run's htars, and a shared slot when there is a budget, for as long as the block runs
+    async with self.htar_limit:
+      if self.slots:
+        async with self.slots.acquire( name ) as n:
+          yield n
+      else:
+        yield None
+
+  async def hsi( self, argv ):
+    async with self.hsi_limit:
+      return await self.run( argv, timeout=self.hsi_timeout )
+
+
+class Throughput:
+  """Bytes htar reported writing and the time it spent doing so, summed over a run.
+
+  Runs can be appended to a JSON history file keyed by class of service and thread count, which is what
+  plan() uses to estimate how long future runs will take."""
+  def __init__( self ):
+    self.bytes = 0
+    self.seconds = 0.
+    self.first = None
+    self.last = None
+    self.lock = Lock()
+
+  def record( self, written, seconds ):
+    now = time.time()
+    with self.lock:
+      self.bytes += written
+      self.seconds += seconds
+      self.first = min( self.first or now - seconds, now - seconds )
+      self.last = max( self.last or now, now )
+
+  def rate( self ):
+    return self.bytes / self.seconds if self.seconds else None
+
+  def wall( self ):
+    # seconds from the start of the first htar to the end of the last, ie with concurrency
+    return self.last - self.first if self.first is not None else 0.
+
+  @staticmethod
+  def history( path ):
+    try:
+      with open( path, 'r' ) as f:
+        return json.load( f )
+    except FileNotFoundError:
+      return []
+
+  def save( self, path, cos, threads ):
+    if not self.bytes or not self.wall():
+      return
+    # read-modify-write under a lock so concurrent runs sharing a history do not lose entries
+    with open( f'{path}.lock', 'w' ) as lock:
+      fcntl.flock( lock, fcntl.LOCK_EX )
+      runs = self.history( path )
+      runs.append( { 'time': time.time(), 'host': socket.gethostname(), 'cos': str(cos), 'threads': threads, 'bytes': self.bytes, 'seconds': self.wall(), 'htar_seconds': self.seconds } )
+      with open( f'{path}.tmp', 'w' ) as f:
+        json.dump( runs, f, indent=1 )
+      os.replace( f'{path}.tmp', path )
+    logger.info(f"Recorded {self.bytes} bytes in {self.wall():.1f}s for cos {cos} with {threads} threads to {path}")
+
+  @classmethod
+  def estimate( cls, path, cos, threads ):
+    # aggregate bytes/s of past runs with the same cos and threads; otherwise scale the per-thread rate of any run with that cos
+    runs = [ r for r in cls.history( path ) if r['cos'] == str(cos) ] if path else []
+    same = [ r for r in runs if r['threads'] == threads ]
+    if same:
+      return sum( r['bytes'] for r in same ) / sum( r['seconds'] for r in same ), f'{len(same)} runs with cos {cos} and {threads} threads'
+    if runs:
+      per_thread = sum( r['bytes'] for r in runs ) / sum( r['seconds'] * r['threads'] for r in runs )
+      return per_thread * threads, f'{len(runs)} runs with cos {cos}, scaled to {threads} threads'
+    return None, f'no recorded runs with cos {cos}'
+
+throughput = Throughput()
+
+def human( amount ):
+  for unit in ( '', 'k', 'm', 'g', 't' ):
+    if abs( amount ) < 1024 or unit == 't':
+      return f'{amount:.1f}{unit}' if unit else f'{amount}'
+    amount /= 1024
+
+def plan( commands, created, hsi_prefix='/', history=None, archive_cos=110, threads=2, tape_capacity=18*1024**4 ):
+  """Summarises what a run would do for each experiment: the archives with their bytes and member counts,
+  how their sizes are distributed, the hpss directories that would be created, and how long htar should
+  take and how many tapes it should fill based on the throughput of past runs."""
+  rate, basis = Throughput.estimate( history, archive_cos, threads )
+  report = { 'archive_cos': archive_cos, 'threads': threads, 'rate': rate, 'rate_basis': basis, 'experiments': {} }
+  for cmd in commands:
+    experiment = cmd['experiment']
+    e = report['experiments'].setdefault( experiment, { 'archives': [], 'distribution': {}, 'directories': [] } )
+    e['archives'].append( { 'archive_path': cmd['archive_path'], 'bytes': cmd['bytes'], 'files': cmd['files'], 'compressed': cmd['compressed'], 'done': bool( cmd['exists_okay'] ) } )
+    relative = ''
+    for c in str( cmd['hsi_directory'] ).split('/'):
+      relative = relative + '/' + c
+      if relative in created:
+        e['directories'].append( os.path.normpath( f'{hsi_prefix}/{relative}' ) )
+  for experiment, e in report['experiments'].items():
+    todo = [ a for a in e['archives'] if not a['done'] ]
+    e['bytes'] = sum( a['bytes'] for a in todo )
+    e['files'] = sum( a['files'] for a in todo )
+    # power of two size buckets
+    for a in todo:
+      bucket = human( 2 ** max( 0, a['bytes'].bit_length() - 1 ) )
+      e['distribution'][ bucket ] = e['distribution'].get( bucket, 0 ) + 1
+    e['directories'] = sorted( set( e['directories'] ) )
+    e['seconds'] = e['bytes'] / rate if rate else None
+    e['tapes'] = -( -e['bytes'] // tape_capacity )
+  return report
+
+def plan_table( report ):
+  rows = [ ( 'experiment', 'archives', 'done', 'files', 'bytes', 'largest', 'smallest', 'dirs', 'hours', 'tapes' ) ]
+  for experiment, e in report['experiments'].items():
+    todo = [ a['bytes'] for a in e['archives'] if not a['done'] ]
+    rows.append( ( experiment, str( len( todo ) ), str( len( e['archives'] ) - len( todo ) ), str( e['files'] ), human( e['bytes'] ),
+                   human( max( todo, default=0 ) ), human( min( todo, default=0 ) ), str( len( e['directories'] ) ),
+                   f"{e['seconds']/3600:.2f}" if e['seconds'] is not None else '?', str( e['tapes'] ) ) )
+  widths = [ max( len( r[i] ) for r in rows ) for i in range( len( rows[0] ) ) ]
+  lines = [ '  '.join( c.rjust( w ) if i else c.ljust( w ) for i, ( c, w ) in enumerate( zip( r, widths ) ) ) for r in rows ]
+  rate = f"{human( report['rate'] )}/s" if report['rate'] else 'unknown'
+  lines.append( f"estimated rate {rate} ({report['rate_basis']})" )
+  return '\n'.join( lines )
+
+
+@timed('archive_folder')
+async def archive_folder( executor, kwargs, dry_run=True, prefetch=0, prefetch_read=False, keep_filelist=False, retries=3, retry_delay=30 ):
+  """Creates and lists back one archive, retrying whichever step failed up to retries times with an
+  exponentially growing, jittered delay. Returns True if both succeeded, False if not, None on a dry run."""
+  extract_script=kwargs['extract_script']
+  filelist=kwargs['filelist']
+  directory=kwargs['directory']
+  commands=kwargs['commands']
+  archive=kwargs['archive']
+  log=kwargs['log']
+  duration = 0
+  ok = None
+  if dry_run:
+    logger.error(f"Not archiving folder {directory}, archive {archive} from {filelist}, log {log} -- use --force to actually perform archive")
+  else:
+    logger.info(f"Archiving folder {directory}, archive {archive} from {filelist}, log {log}")
+    try:
+      if log.exists():
+        os.unlink( log )
+      created, listed, attempt = [], [], 0
+      while True:
+        attempt += 1
+        text = ''
+        # the htar is only held while it runs, not while backing off
+        async with executor.htar( kwargs['archive_path'] ):
+          if not created:
+            start_time = time.monotonic()
+            prefetcher = None
+            if prefetch:
+              prefetcher = Prefetcher( filelist, log, cwd=kwargs['cwd'], budget=prefetch, read=prefetch_read )
+              prefetcher.start()
+            try:
+              returncode, _ = await executor.run( commands, log=log, cwd=kwargs['cwd'], timeout=executor.timeout )
+            finally:
+              if prefetcher:
+                await asyncio.to_thread( prefetcher.stop )
+                logger.debug(f"prefetched {prefetcher.files} files ({prefetcher.bytes} bytes) for {archive}")
+            duration = (time.monotonic() - start_time)/60
+            text = open( log, 'r' ).read() if log.exists() else ''
+            created, _ = archive_status( text, kwargs['archive_path'] )
+            if returncode != 0 or not created:
+              logger.warning(f"htar create of {archive} returned {returncode} on attempt {attempt}")
+              created = []
+          if created:
+            returncode, _ = await executor.run( kwargs['listing'], log=log, timeout=executor.timeout )
+            text = open( log, 'r' ).read() if log.exists() else ''
+            _, listed = archive_status( text, kwargs['archive_path'] )
+            if returncode != 0 or not listed:
+              logger.warning(f"htar listing of {archive} returned {returncode} on attempt {attempt}")
+              listed = []
+        if ( created and listed ) or attempt > retries:
+          break
+        delay = retry_delay * 2 ** ( attempt - 1 ) * ( 0.5 + random.random() )
+        logger.warning(f"retrying {archive} in {delay:.0f}s ({attempt} of {retries} retries)")
+        await asyncio.sleep( delay )
+      ok = bool( created and listed )
+      if not ok:
+        logger.error(f"Archive {archive} for {directory} failed after {attempt} attempts")
+      #logger.debug(f"Finished writing {archive} in {duration} minutes")
+      # append this log to the extract script log
+      if log.exists():
+        sidecar = Path( f"{extract_script.parent}/{archive}.log.gz" )
+        logger.debug(f"Compressing archive logs for {archive} to {sidecar}")
+        # appended as another gzip member so the logs of earlier runs, which their #STATUS lines refer to, are kept
+        with gzip.open( sidecar, 'at' ) as f:
+          f.write( text )
+        # only a one line summary goes into the extract script
+        if created:
+          throughput.record( int(created[-1]), duration * 60 )
+        with open( extract_script, 'a' ) as l:
+          l.write( f"#STATUS: {kwargs['archive_path']} create={'OK' if created else 'FAILED'} bytes={created[-1] if created else 0} list={'OK' if listed else 'FAILED'} files={listed[-1] if listed else 0} log={sidecar.name} attempts={attempt} content={kwargs['bytes']}\n" )
+        os.unlink( log )
+        if not keep_filelist:
+          os.unlink( filelist )
+    except Exception as e:
+      logger.error(f"Archive {archive} for {directory} failed: {e}")
+      raise e
+
+  logger.info(f"Completed archiving partial folder {directory}, archive {archive} in {str(int(duration))+' minutes'}")
+
+  return ok
+
+
+def add_arguments( parser ):
+  parser.add_argument('directory', nargs='+', help='directories to include in htar archives')
+  parser.add_argument('--size', type=str, help='size in bytes of each archive', default='100g' )
+  parser.add_argument('--hsi_prefix', type=str, help='hsi prefix path to place archives', default='/cryoEM/exp/' )
+  parser.add_argument('--force', '-f', help='Commit all changes on disk and tape', default=False, action='store_true' )
+  parser.add_argument('--really_force', '-F', help='Overwrite any previous archive scripts', default=False, action='store_true' )
+  parser.add_argument('--threads', help='Number of concurrent htars to run', default=4, type=int )
+  parser.add_argument('--hsi_threads', help='Number of concurrent hsi commands (directory creation and checks) to run', default=64, type=int )
+  parser.add_argument('--timeout', type=float, help='seconds each htar may run before it is stopped (0 for no limit)', default=86400 )
+  parser.add_argument('--hsi_timeout', type=float, help='seconds each hsi command may run before it is stopped', default=600 )
+  parser.add_argument('--no_relative_paths', help='Do not use relative paths from cwd', default=False, action='store_true' )
+  parser.add_argument('--do_not_delete', help='Do not delete local files after archiving', default=False, action='store_true' )
+  parser.add_argument('--archive_cos', help='set HPSS Class of Service (COS) for archive', default=110  )
+  parser.add_argument('--index_cos', help='set HPSS Class of Service (COS) for index file', default=110  )
+  parser.add_argument('--working_dir', type=str, help='directory to write archive filelists and logs to', default='/tmp/' )
+  parser.add_argument('--filelist_buffer', type=str, help='maximum size of the in-memory buffer for each filelist before it is flushed', default='8m' )
+  parser.add_argument('--prefetch', type=str, help='warm up to this many bytes of upcoming files while htar runs (0 to disable)', default='0' )
+  parser.add_argument('--prefetch_read', help='prefetch by reading files rather than with posix_fadvise', default=False, action='store_true' )
+  parser.add_argument('--verify', type=int, help='number of random members of each archive to extract and compare before deleting (0 to disable)', default=0 )
+  parser.add_argument('--verify_scratch', type=str, help='directory to extract verification samples to (defaults to --working_dir)', default=None )
+  parser.add_argument('--slots_dir', type=str, help='directory of lock files limiting concurrent htars across all invocations that share it', default=None )
+  parser.add_argument('--slots', type=int, help='number of concurrent htars allowed across all invocations sharing --slots_dir', default=8 )
+  parser.add_argument('--compress', help='gzip file classes that compress well into a staging area and archive the compressed copies', default=False, action='store_true' )
+  parser.add_argument('--compress_dir', type=str, help='directory to stage compressed copies in (defaults to --working_dir)', default=None )
+  parser.add_argument('--compress_ratio', type=float, help='compress file classes whose sampled compressed/raw ratio is at most this', default=0.8 )
+  parser.add_argument('--compress_level', type=int, help='gzip compression level', default=1 )
+  parser.add_argument('--compress_threads', type=int, help='number of files to compress concurrently', default=4 )
+  parser.add_argument('--dedup_index', type=str, help='sqlite index of archived files; files already on tape are restored from there rather than archived again', default=None )
+  parser.add_argument('--dedup_min_size', type=str, help='only deduplicate files at least this large', default='1m' )
+  parser.add_argument('--plan', type=str, help='write a JSON report of the archives, bytes, hpss directories and estimated time of this run to this path, and log it as a table', default=None )
+  parser.add_argument('--throughput_history', type=str, help='JSON file of past run throughputs; real runs are appended to it and --plan estimates from it', default=None )
+  parser.add_argument('--tape_capacity', type=str, help='capacity of a tape for --plan estimates', default='18t' )
+  parser.add_argument('--retries', type=int, help='number of times to retry a failed htar create or listing', default=3 )
+  parser.add_argument('--retry_delay', type=float, help='seconds to wait before the first retry; doubles with each further retry', default=30 )
+  parser.add_argument('--stream', help='Start archiving each folder as soon as its file lists are built', default=False, action='store_true' )
+  parser.add_argument('--profile', type=str, help='write a report of time spent in each phase of the run to this file', default=None )
+  parser.add_argument('--profile_cpu', help='include cProfile statistics in the --profile report', default=False, action='store_true' )
+  parser.add_argument('--profile_memory', help='include tracemalloc top allocations in the --profile report', default=False, action='store_true' )
+  parser.add_argument('--verbose', help='Debug output', default=False, action='store_true' )
+
+  return parser
+
+
+async def settle_directory( executor, directory, d, verify=None, dedup=None, force=False, do_not_delete=False ):
+  # validate, verify and index the archives of one folder and delete it if they are all good; returns whether they were
+  # any error, eg hsi failing to list an archive, fails just this folder rather than the whole run
+  try:
+    cache = open( d['extract_script'], 'r' ).read() if d['extract_script'].exists() else None
+    d['valid'] = list( await asyncio.gather( *[ validate_archive( executor, d['extract_script'], directory, c['archive_path'], cache=cache, files=c['files'], size=c['bytes'] ) for c in d['commands'] ], return_exceptions=True ) )
+    # let every check finish before giving up on the folder so none are left running
+    for e in d['valid']:
+      if isinstance( e, Exception ):
+        raise e
+    # an archive job that crashed fails the folder whatever its extract script says
+    good = not d['failed'] and not False in d['valid']
+
+    # sample archives that look good back from tape before anything gets deleted
+    candidates = d['commands'] if verify and good else []
+    verified = dict( zip( [ c['archive_path'] for c in candidates ], await asyncio.gather( *[ verify( c ) for c in candidates ] ) ) )
+
+    # remember what this run put on tape so later runs can skip identical files
+    if dedup and good:
+      await asyncio.gather( *[ asyncio.to_thread( dedup.add, c ) for c in d['commands'] if not c['exists_okay'] and not verified.get( c['archive_path'] ) == False ] )
+
+    res = []
+    for c, valid in zip( d['commands'], d['valid'] ):
+      res.append( False if verified.get( c['archive_path'] ) == False else valid )
+    ok = len( [ x for x in res if x == True ] )
+    logger.info(f"RES: {directory} {ok} / {len(res)}{' (archive job failed)' if d['failed'] else ''}")
+    # okay to delete directory!
+    if d['failed'] or any( x == False for x in res ):
+      logger.error(f"Archive validation of {directory} failed!")
+      return False
+    elif not force:
+      logger.error(f"Dry run... would be deleting {directory}")
+      delete_folder( directory, dry_run=True )
+    elif not False in res:
+      # remove dry_rund
+      delete = not do_not_delete and force
+      logger.error(f"DELETE? {delete} {directory}")
+      await asyncio.to_thread( delete_folder, directory, dry_run=not delete )
+      if d['staging']:
+        await asyncio.to_thread( delete_folder, d['staging'], dry_run=not delete )
+    else:
+      if force:
+        logger.error(f"Not deleting directory {directory} due to failed archive!")
+    return True
+  except Exception as e:
+    logger.error(f"Archive validation of {directory} failed: {e}")
+    return False
+
+def main( args, layout ):
+
+  if args.really_force == True:
+    args.force = True
+
+  lvl = logging.INFO
+  if args.verbose:
+    lvl = logging.DEBUG
+  logger.setLevel(lvl)
+  ch = logging.StreamHandler()
+  ch.setLevel(lvl)
+  ch.setFormatter(CustomFormatter())
+  logger.addHandler(ch)
+
+  if args.profile:
+    profile.enable( cprofile=args.profile_cpu, memory=args.profile_memory )
+    # written on exit so failed runs are reported too
+    atexit.register( profile.report, args.profile )
+
+  try:
+    failed = asyncio.run( archive_directories( args, layout ) )
+  except ( KeyboardInterrupt, asyncio.CancelledError ):
+    logger.error("Interrupted; archives in flight were stopped and will be redone by the next run")
+    sys.exit( 130 )
+  if failed:
+    logger.error(f"{failed} failures among archives and folders; see above")
+    sys.exit( 1 )
+
+async def archive_directories( args, layout ):
+  archive_size = convert_to_bytes( args.size )
+  # htar runs from each folder's parent, so filelists, logs and scratch space must not be relative to ours
+  args.working_dir = os.path.abspath( args.working_dir )
+  if args.verify_scratch:
+    args.verify_scratch = os.path.abspath( args.verify_scratch )
+  if args.compress_dir:
+    args.compress_dir = os.path.abspath( args.compress_dir )
+  commands = []
+  jobs = []
+  settling = []
+  created = {}
+  # share the htar budget with other invocations using the same slots directory
+  slots = HtarSlots( args.slots_dir, slots=args.slots ) if args.slots_dir else None
+  executor = Executor( htars=args.threads, hsis=args.hsi_threads, slots=slots, timeout=args.timeout or None, hsi_timeout=args.hsi_timeout )
+  executor.start()
+  archive = partial(archive_folder, executor, dry_run=not args.force, prefetch=convert_to_bytes( args.prefetch ), prefetch_read=args.prefetch_read, keep_filelist=args.verify > 0 or bool(args.dedup_index), retries=args.retries, retry_delay=args.retry_delay)
+  verify = None
+  if args.verify > 0:
+    verify = partial(verify_archive, executor, samples=args.verify, scratch=args.verify_scratch or args.working_dir, dry_run=not args.force)
+  dedup = None
+  if args.dedup_index:
+    dedup = DedupIndex( args.dedup_index, min_size=convert_to_bytes( args.dedup_min_size ), dry_run=not args.force )
+  settle = partial(settle_directory, executor, verify=verify, dedup=dedup, force=args.force, do_not_delete=args.do_not_delete)
+  compressor = None
+  if args.compress:
+    compressor = Compressor( args.compress_dir or args.working_dir, ratio=args.compress_ratio, level=args.compress_level, threads=args.compress_threads, dry_run=not args.force )
+  # limit how far scanning may run ahead of htar when streaming
+  queued = asyncio.Semaphore( 2 * args.threads )
+  # archives report back as they finish so each folder can be settled as soon as all of its archives have
+  finished = asyncio.Queue()
+  async def job( cmd, release=None ):
+    try:
+      result = await archive( cmd )
+    except Exception as e:
+      result = e
+    finally:
+      if release:
+        release()
+    finished.put_nowait( ( cmd, result ) )
+  def submit( cmd, release=None ):
+    jobs.append( asyncio.ensure_future( job( cmd, release=release ) ) )
+
+  # stop everything in flight on ctrl-c or kill
+  loop = asyncio.get_running_loop()
+  for sig in ( signal.SIGINT, signal.SIGTERM ):
+    loop.add_signal_handler( sig, asyncio.current_task().cancel )
+
+  failed = 0
+  try:
+    for directory in args.directory:
+
+      if args.no_relative_paths or directory.startswith('/'):
+        raise NotImplementedError("no relative paths not yet supported")
+
+      for parent, folder, hsi_directory in layout.folders( directory ):
+        logger.info(f"Analysing folder {parent}/{folder}")
+        # scanning and planning is filesystem bound, so it runs in a thread while the loop keeps htar and hsi going
+        cmds = await asyncio.to_thread( profile.call, list, setup_folder( parent, folder, hsi_directory, archive_size=archive_size, hsi_prefix=args.hsi_prefix, dry_run=not args.force, purge=args.really_force, working_dir=args.working_dir, buffer_size=convert_to_bytes( args.filelist_buffer ), archive_cos=args.archive_cos, index_cos=args.index_cos, compressor=compressor, dedup=dedup ) )
+        await check_previous( executor, cmds, purge=args.really_force )
+        for cmd in cmds:
+          cmd['experiment'] = experiment_of( directory )
+          commands.append( cmd )
+          # queue each archive as soon as its folder has been planned
+          if args.stream:
+            await create_hsi_directories( executor, cmd['hsi_directory'], created=created, hsi_prefix=args.hsi_prefix, dry_run=not args.force )
+            if not cmd['exists_okay']:
+              await queued.acquire()
+              submit( cmd, release=queued.release )
+
+    if not args.stream:
+      # create the directory path in hpss
+      await asyncio.gather( *[ create_hsi_directories( executor, cmd['hsi_directory'], created=created, hsi_prefix=args.hsi_prefix, dry_run=not args.force ) for cmd in commands ] )
+
+      #logger.warn(f'{commands}')
+      # filter out archives that are fine
+      for cmd in commands:
+        if not cmd['exists_okay']:
+          submit( cmd )
+    #sys.exit(127)
+
+    execute = len( jobs )
+    if execute == 0:
+      logger.warn("No archive actions required")
+
+    #logger.warn(f"COMMANDS: {commands}")
+
+    # delete folders if they've transfered okay
+    # 1) case where it all uploaded prior
+    if execute == 0 and not is_exp_directory( directory ):
+      if verify and False in await asyncio.gather( *[ verify( c ) for c in commands ] ):
+        logger.error(f"Sampled verification of {directory} failed!")
+        failed += 1
+      else:
+        logger.error(f"ABOUT TO DELETE {directory}")
+        # remove dry_rund
+        await asyncio.to_thread( delete_folder, directory, dry_run=not args.force or args.do_not_delete )
+        for staging in set( c['staging'] for c in commands if c['staging'] ):
+          await asyncio.to_thread( delete_folder, staging, dry_run=not args.force or args.do_not_delete )
+
+    # 2) when we did some uploading; each folder is settled once its own archives are done
+    else:
+      # reformat all archvies for each directory
+      directories = {}
+      for this in commands:
+        if not this['directory'] in directories:
+          directories[ this['directory'] ] = { 'extract_script': this['extract_script'], 'staging': this['staging'], 'commands': [], 'waiting': 0, 'failed': False }
+        directories[ this['directory'] ]['commands'].append( this )
+        if not this['exists_okay']:
+          directories[ this['directory'] ]['waiting'] += 1
+
+      for directory, d in directories.items():
+        if not d['waiting']:
+          settling.append( asyncio.ensure_future( settle( directory, d ) ) )
+
+      # actually run it! in parallel!
+      for i in range( execute ):
+        cmd, result = await finished.get()
+        logger.warn(f"{i} of {execute-1} returns {result}")
+        d = directories[ cmd['directory'] ]
+        if isinstance( result, Exception ):
+          logger.error(f"{i} command failed ({result}): {cmd['archive_path']}")
+          d['failed'] = True
+          failed += 1
+        elif args.force and not result:
+          logger.error(f"{i} command failed: {cmd['archive_path']}")
+          failed += 1
+        d['waiting'] -= 1
+        if not d['waiting']:
+          settling.append( asyncio.ensure_future( settle( cmd['directory'], d ) ) )
+      settled = await asyncio.gather( *settling )
+      # dry runs have no extract scripts to validate against, so only count folders that failed for real
+      if args.force:
+        failed += settled.count( False )
+
+  except ( asyncio.CancelledError, Exception ):
+    # stop what is still in flight here, where subprocesses can be shut down cleanly, rather than leave it to asyncio.run
+    for task in jobs + settling:
+      task.cancel()
+    await asyncio.gather( *jobs, *settling, return_exceptions=True )
+    raise
+
+  if args.throughput_history and args.force:
+    throughput.save( args.throughput_history, args.archive_cos, args.threads )
+
+  if args.plan:
+    report = plan( commands, created, hsi_prefix=args.hsi_prefix, history=args.throughput_history, archive_cos=args.archive_cos, threads=args.threads, tape_capacity=convert_to_bytes( args.tape_capacity ) )
+    with open( args.plan, 'w' ) as f:
+      json.dump( report, f, indent=1 )
+    logger.info(f"Plan written to {args.plan}\n{plan_table( report )}")
+
+  if compressor:
+    logger.info( compressor.summary( htar_rate=throughput.rate() ) )
+  if dedup:
+    logger.info( dedup.summary() )
+
+  # filelists kept around for verification and indexing
+  if args.force and ( args.verify > 0 or dedup ):
+    for cmd in commands:
+      try:
+        os.unlink( cmd['filelist'] )
+      except FileNotFoundError:
+        pass
+
+  return failed
@@ -0,0 +1,83 @@
+#!/bin/env python3
+
+import argparse
+import os
+import tempfile
+import time
+from threading import Thread
+from htar_engine import Prefetcher, convert_to_bytes
+
+# Times how long a stand-in for htar takes to read an archive's worth of cold files with and without --prefetch.
+# The stand-in reads each file in the filelist in turn, spends --work seconds per MB on it as htar does writing to
+# tape, and logs 'HTAR: a' lines that the prefetcher follows. Run it against a directory on the filesystem being
+# archived from; the page cache is dropped for the files before every pass, which needs no privileges.
+
+def evict( paths ):
+  for path in paths:
+    fd = os.open( path, os.O_RDONLY )
+    try:
+      os.fsync( fd )
+      os.posix_fadvise( fd, 0, 0, os.POSIX_FADV_DONTNEED )
+    finally:
+      os.close( fd )
+
+def htar( paths, log, work, chunk_size=1024*1024 ):
+  with open( log, 'a' ) as l:
+    for path in paths:
+      with open( path, 'rb' ) as f:
+        while True:
+          chunk = f.read( chunk_size )
+          if not chunk:
+            break
+          time.sleep( work * len(chunk) / 1024 / 1024 )
+      l.write( f"HTAR: a   {path}\n" )
+      l.flush()
+
+def run( paths, filelist, log, work, prefetch=0, read=False ):
+  evict( paths )
+  if os.path.exists( log ):
+    os.unlink( log )
+  prefetcher = None
+  if prefetch:
+    prefetcher = Prefetcher( filelist, log, cwd='/', budget=prefetch, read=read, interval=0.05 )
+    prefetcher.start()
+  start = time.monotonic()
+  reader = Thread( target=htar, args=( paths, log, work ) )
+  reader.start()
+  reader.join()
+  seconds = time.monotonic() - start
+  if prefetcher:
+    prefetcher.stop()
+  return seconds
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Benchmark htar reads of cold files with and without prefetching.' )
+  parser.add_argument('directory', help='scratch directory on the filesystem to benchmark' )
+  parser.add_argument('--files', type=int, help='number of files', default=64 )
+  parser.add_argument('--size', type=str, help='size of each file', default='16m' )
+  parser.add_argument('--work', type=float, help='seconds htar spends per MB besides reading it', default=0.002 )
+  parser.add_argument('--prefetch', type=str, help='prefetch budget', default='256m' )
+  parser.add_argument('--prefetch_read', help='read files rather than use fadvise', default=False, action='store_true' )
+  parser.add_argument('--repeat', type=int, help='passes of each mode', default=3 )
+  args = parser.parse_args()
+
+  size = convert_to_bytes( args.size )
+  with tempfile.TemporaryDirectory( dir=args.directory ) as scratch:
+    paths = []
+    for n in range( args.files ):
+      path = os.path.join( scratch, f'file{n}' )
+      with open( path, 'wb' ) as f:
+        for offset in range( 0, size, 1024*1024 ):
+          f.write( os.urandom( min( 1024*1024, size - offset ) ) )
+      paths.append( path )
+    filelist = os.path.join( scratch, 'filelist' )
+    with open( filelist, 'w' ) as f:
+      f.write( ''.join( f"{p}\n" for p in paths ) )
+    log = os.path.join( scratch, 'filelist.out' )
+
+    total = args.files * size / 1024 / 1024
+    for name, prefetch in ( ( 'no prefetch', 0 ), ( f'prefetch {args.prefetch}', convert_to_bytes( args.prefetch ) ) ):
+      times = sorted( run( paths, filelist, log, args.work, prefetch=prefetch, read=args.prefetch_read ) for _ in range( args.repeat ) )
+      median = times[ len(times) // 2 ]
+      print(f"{name:>20}: median {median:.2f}s ({total/median:.1f} MB/s) over {args.repeat} passes of {args.files} x {args.size}")